@@ -1,21 +1,61 @@
 # app.py - Fully Resilient Mangatek Scraper with Enhanced Proxy & UA Rotation, Rate Limiting, and Backoff
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, Response
 from typing import List, Optional, Dict, Any
 import httpx
-from bs4 import BeautifulSoup
+from lxml import etree, html as lxml_html
+from lxml.cssselect import CSSSelector
+import os
 import re
+import asyncio
 import logging
 import json
 import random
-from urllib.parse import urljoin, unquote, urlparse
+import hashlib
+import itertools
+import threading
+from urllib.parse import urljoin, unquote, urlparse, quote
+from urllib.request import getproxies
 import time
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from collections import deque
+from cachetools import TTLCache
 import backoff  # Add this library for exponential backoff (pip install backoff)
+try:
+    import orjson  # محلل/مُسلسل JSON مكتوب بـ C (pip install orjson)
+except ImportError:
+    orjson = None
 
 # إعداد السجلات (Logging)
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 logger = logging.getLogger("mangatek_scraper")
 
-app = FastAPI(title="Mangatek Scraper API (Resilient Edition)", version="0.5.0")
+json_loads = orjson.loads if orjson else json.loads
+
+def json_dumps(content: Any) -> bytes:
+    if orjson: return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+class ORJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return json_dumps(content)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # عميل HTTP واحد دائم لكل بروكسي (None = اتصال مباشر) لإعادة استخدام اتصالات TCP/TLS
+    app.state.clients = {proxy: build_client(proxy) for proxy in (PROXIES_LIST or [None])}
+    # تسخين الاتصالات في الخلفية: حل DNS ومصافحة TLS تتم قبل أول طلب حقيقي دون تأخير الإقلاع
+    warmup = asyncio.ensure_future(prewarm_clients(app.state.clients.values())) if PREWARM_CONNECTIONS else None
+    try:
+        yield
+    finally:
+        if warmup: warmup.cancel()
+        for client in app.state.clients.values():
+            await client.aclose()
+
+app = FastAPI(title="Mangatek Scraper API (Resilient Edition)", version="0.5.0", lifespan=lifespan,
+              default_response_class=ORJSONResponse if orjson else JSONResponse)
 BASE = "https://mangatek.com"
 
 # 1. قائمة هويات المتصفح (User-Agent Rotation) 🎭 - Expanded list for better variety
@@ -31,6 +71,34 @@ USER_AGENTS = [
     "Mozilla/5.0 (iPad; CPU OS 17_1 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.1 Mobile/15E148 Safari/604.1",
     "Mozilla/5.0 (Android 14; Mobile; rv:109.0) Gecko/20100101 Firefox/119.0"
 ]
+# headers ثابتة لتبدو كمتصفح حقيقي - تُضبط مرة واحدة على العملاء المشتركين
+DEFAULT_HEADERS = {
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7",
+    "Accept-Language": "ar,en-US;q=0.9,en;q=0.8",
+    "Accept-Encoding": "gzip, deflate, br",
+    "Connection": "keep-alive",
+    "Upgrade-Insecure-Requests": "1",
+    "Sec-Fetch-Dest": "document",
+    "Sec-Fetch-Mode": "navigate",
+    "Sec-Fetch-Site": "none",
+    "Sec-Fetch-User": "?1"
+}
+REFERERS = ["https://www.google.com/", "https://www.bing.com/", BASE]
+# كل تركيبات الهوية/المُحيل مبنية مسبقاً: لا نبني dict جديداً في كل طلب
+# المُحيل في الحلقة الخارجية: الطلبات المتتالية تتنقل بين الهويات لا بين المُحيلات
+ROTATING_HEADERS = [{"User-Agent": ua, "Referer": ref} for ref in REFERERS for ua in USER_AGENTS]
+_headers_rr = itertools.count()
+# فحص الصور (?verify) يجب أن يبدو كطلب <img> من صفحة القارئ لا كتنقل إلى مستند
+IMAGE_PROBE_HEADERS = [{
+    "User-Agent": ua,
+    "Referer": BASE + "/",
+    "Accept": "image/avif,image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8",
+    "Sec-Fetch-Dest": "image",
+    "Sec-Fetch-Mode": "no-cors",
+    "Sec-Fetch-Site": "cross-site",
+} for ua in USER_AGENTS]
+# ترويسات تخص التنقل فقط: تُحذف من طلبات الصور رغم أنها مضبوطة على العميل
+_NAVIGATION_ONLY_HEADERS = ("Upgrade-Insecure-Requests", "Sec-Fetch-User")
 
 # 2. قائمة البروكسيات (Proxy Rotation) 🌐
 # ملاحظة: استبدل هذه العناوين ببروكسيات تعمل لديك.
@@ -40,177 +108,552 @@ PROXIES_LIST = [
     # "http://user:pass@ip:port",
     # مثال لبروكسي بدون كلمة سر: "http://1.2.3.4:8080"
 ]
+# نتتبع نجاح كل بروكسي في آخر PROXY_HEALTH_WINDOW محاولة ونفضّل السليمة منها
+PROXY_HEALTH_WINDOW = 20
+PROXY_MIN_SUCCESS_RATE = 0.5
+PROXY_LATENCY_ALPHA = 0.3  # وزن آخر قياس في المتوسط المتحرك الأسي لزمن الاستجابة
+PROXY_LATENCY_MAX_AGE = 30  # ثواني - قياس أقدم من هذا لا يُعتمد عليه في المقارنة
+PROXY_LATENCY_SLACK = 1.5  # نتخطى صاحب الدور فقط إن كان أبطأ من جاره بهذه النسبة، وإلا يبقى التدوير متساوياً
 
 # 3. إضافة تأخير أساسي بين الطلبات (Rate Limiting) ⏳
 MIN_DELAY = 2  # ثواني minimun
 MAX_DELAY = 5  # ثواني maximum
+_next_fetch_at = 0.0  # أقرب وقت مسموح للطلب التالي نحو الموقع (time.monotonic)
+_encoding_logged = False
+# إعدادات مجمع الاتصالات المشترك (عميل واحد لكل بروكسي يعيش طوال عمر التطبيق)
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "1") != "0"  # 0 = عدة اتصالات HTTP/1.1 بدلاً من تعدد الإرسال
+PREWARM_CONNECTIONS = os.getenv("PREWARM_CONNECTIONS", "1") != "0"  # فتح اتصال لكل عميل عند الإقلاع
+CONNECT_RETRIES = 2  # إعادة محاولات الاتصال داخل النقل نفسه قبل أن يصل الخطأ إلى backoff
+# العميل المباشر يمر عبر بروكسي البيئة (HTTP_PROXY/HTTPS_PROXY/ALL_PROXY) إن وُجد
+_ENV_PROXIED = any(scheme in getproxies() for scheme in ("http", "https", "all"))
+HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=50, keepalive_expiry=60)
+# بوابة قبول: أقصى عدد طلبات متزامنة نحو الموقع (الحد الصلب هو HTTP_LIMITS)
+UPSTREAM_SEM = asyncio.Semaphore(int(os.getenv("UPSTREAM_CONCURRENCY", "12")))
+MAX_HTML_BYTES = 5_000_000  # حد أقصى لحجم الصفحة المقروءة (حماية الذاكرة)
+SNIFF_BYTES = 8192  # حجم البداية التي نفحصها بحثاً عن تحدي Cloudflare أو جسم غير HTML
+# حد أقصى لعدد الفصول في طلب /reader/{slug}/batch: كل فصل غير مخزن يأخذ خانة تأخير خاصة به
+# (MIN_DELAY..MAX_DELAY)، فالزمن البارد ≈ (العدد - 1) × 2..5 ثوانٍ ويجب أن يبقى تحت مهلة الموجّه (30 ث في Heroku)
+MAX_BATCH_CHAPTERS = 5
+# إعادة المحاولة للأعطال العابرة فقط: 404/400 لن تتغير بالتكرار
+RETRY_STATUSES = {429, 502, 503, 504}
+RETRY_MAX_WAIT = 8  # ثواني - سقف الانتظار بين محاولتين (expo مع jitter كامل)
+RETRY_MAX_TIME = 30  # ثواني - الميزانية الكلية لجلب رابط واحد
+# قاطع دائرة لكل مضيف: بعد عدة أعطال متتالية نرفض فوراً بدلاً من دفع كلفة المحاولات كاملة
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_MIN_OPEN = 0.5  # ثواني - أول فتح، ثم يتضاعف مع كل فشل في محاولة الاختبار
+CIRCUIT_MAX_OPEN = 60
+
+# 4. ذاكرة مؤقتة للنتائج (TTL Cache) 💾 - الضربة الناجحة تتخطى الجلب والتحليل بالكامل
+CACHE_TTL = 600  # ثواني
+cache = TTLCache(maxsize=1024, ttl=CACHE_TTL)
+
+def _cache_key(*parts) -> str:
+    return "|".join(map(str, parts))
+
+# طلبات قيد التنفيذ لكل مفتاح: الطالبون المتزامنون لنفس المفتاح ينتظرون جلباً واحداً
+_inflight: Dict[str, asyncio.Task] = {}
+
+_MISS = object()
+# ذاكرة سلبية قصيرة للأعطال (status, detail): موقع معطل لا يُضرب مجدداً مع كل طلب خلال NEGATIVE_CACHE_TTL
+NEGATIVE_CACHE_TTL = 30  # ثواني
+_failures = TTLCache(maxsize=512, ttl=NEGATIVE_CACHE_TTL)
+
+async def cached(key: str, compute):
+    entry = cache.get(key, _MISS)
+    if entry is not _MISS: return entry
+    failure = _failures.get(key)
+    if failure is not None: raise HTTPException(*failure)  # استثناء جديد: لا تتراكم الإطارات على نسخة مشتركة
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_compute_and_store(key, compute))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    # shield: انقطاع أحد العملاء لا يلغي الجلب المشترك على البقية
+    return await asyncio.shield(task)
+
+async def _compute_and_store(key: str, compute):
+    # نخزن النتيجة مع نسختها المُسلسلة: ضربة الذاكرة المؤقتة تعيد البايتات مباشرة دون ترميز JSON جديد
+    # والبصمة (ETag) تُحسب مرة واحدة هنا لا في كل طلب
+    try:
+        result = await compute()
+    except CircuitOpenError:
+        # مدة الفتح ومحاولة الاختبار يديرهما القاطع؛ تخزين الرفض 30 ثانية كان سيتجاوزهما
+        raise
+    except HTTPException as e:
+        # نخزن (الحالة، التفاصيل) فقط لا كائن الاستثناء: تتبعه يُبقي متغيرات الطلب حية
+        _failures[key] = (e.status_code, e.detail)
+        raise
+    except httpx.HTTPError as e:
+        status = e.response.status_code if isinstance(e, httpx.HTTPStatusError) else None
+        failure = _failures[key] = (404 if status == 404 else 502, f"Upstream request failed ({status or type(e).__name__})")
+        raise HTTPException(*failure) from e
+    body = json_dumps(result)
+    etag = '"' + hashlib.blake2b(body, digest_size=8).hexdigest() + '"'
+    entry = cache[key] = (result, body, etag)
+    return entry
+
+def json_bytes_response(entry, request: Request) -> Response:
+    headers = {"ETag": entry[2], "Cache-Control": f"public, max-age={CACHE_TTL}"}
+    # العميل يملك النسخة نفسها: 304 بلا جسم
+    if entry[2] in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    return Response(content=entry[1], media_type="application/json", headers=headers)
+
+# محددات التحقق (ETag/Last-Modified) لكل رابط مع آخر جسم له: عند رد 304 نعيد استخدامه دون تنزيل
+# نخزن البايتات الخام مع ترميزها لا النص المفكوك (str العربي يشغل ضعف حجم UTF-8 تقريباً)،
+# والحدود صغيرة عمداً لتناسب خوادم صغيرة: أسوأ حالة ≈ 64 × VALIDATOR_MAX_BYTES
+VALIDATOR_TTL = 3600  # ثواني
+VALIDATOR_MAX_BYTES = 1_000_000  # الصفحات الأكبر لا تُحفظ للطلبات المشروطة
+_validators = TTLCache(maxsize=64, ttl=VALIDATOR_TTL)
+# أشجار lxml مفهرسة ببصمة المحتوى: الصفحة التي لم تتغير لا تُحلل مرة أخرى
+_trees = TTLCache(maxsize=8, ttl=VALIDATOR_TTL)
+_trees_lock = threading.Lock()  # التحليل يجري في خيوط to_thread
+
+# 5. محددات CSS مُجمّعة مسبقاً (تُترجم إلى XPath مرة واحدة عند الاستيراد) ⚡
+def _css(*selectors: str) -> List[CSSSelector]:
+    return [CSSSelector(s, translator="html") for s in selectors]
+
+def _css_first(*selectors: str) -> List[etree.XPath]:
+    # نسخة لـ select_one: [1] على آخر خطوة في كل فرع يجعل libxml2 يتوقف عند أول تطابق
+    # بدلاً من جمع كل العقد المطابقة في المستند (أول عنصر بترتيب المستند لا يتغير)
+    return [etree.XPath(" | ".join(branch + "[1]" for branch in sel.path.split(" | "))) for sel in _css(*selectors)]
+
+SEL_MANGA_CARD, SEL_MANGA_LINK, SEL_LINK, SEL_CHAPTER_LINK, SEL_SCRIPT = _css(
+    "a.manga-card", "a[href*='/manga/']", "a[href]", "a[href*='/reader/']", "script"
+)
+SEL_CARD_TITLE = _css_first("h3", ".title", "h2")
+# البدائل هنا متنافية عملياً فنجمعها في تعبير واحد (مسح واحد للشجرة)؛ أما سلاسل العنوان
+# والوصف والغلاف فتبقى مرتبة حسب الأولوية لأن الاتحاد يعيد أول عنصر بترتيب المستند
+(SEL_PAGER,) = _css_first("nav[aria-label='الصفحات'], .pagination, .pagenavi")
+SEL_TITLE = _css_first("h1", ".title", ".entry-title")
+SEL_DESC = _css_first("p.text-gray-300", ".description", ".entry-content p", "meta[name='description']")
+SEL_COVER = _css_first("img.cover", ".cover img", ".thumb img")
+SEL_READER_CONTAINERS = _css_first(".reader", ".reader-container", ".chapter-images", "#reader", ".rdminimal", ".page")
+
+# مصدر كل صورة داخل الحاوية بأولوية data-src > data-lazy-src > src في تقييم XPath واحد:
+# الاتحاد يعيد السمات بترتيب عناصرها في المستند، ولا ننشئ كائن Python لكل <img>
+XP_READER_IMAGE_SRCS = etree.XPath(
+    "(descendant::img[@data-src != '']/@data-src"
+    " | descendant::img[not(@data-src != '') and @data-lazy-src != '']/@data-lazy-src"
+    " | descendant::img[not(@data-src != '') and not(@data-lazy-src != '') and @src != '']/@src)"
+    "[not(starts-with(., 'data:'))]",
+    smart_strings=False,
+)
+
+# 6. تعابير نمطية مُجمّعة مرة واحدة بدلاً من كل استدعاء 🔁
+_RE_URL_ARRAY = re.compile(r'\[\s*(?:"https?://[^"\]]+"(?:\s*,\s*"https?://[^"\]]+")*)\s*\]')
+# أصناف محارف محدودة بدلاً من .*? مع DOTALL، ومع استبعاد "[" أيضاً ومكمّم استحواذي (*+): كل محاولة
+# تتوقف عند "[" التالية ولا تتراجع، فالمسح خطي حتى على مصفوفة غير مغلقة (كان تربيعياً ويحجز الـ GIL)
+_RE_IMAGES_ARRAY = re.compile(r'["\']?images["\']?\s*:\s*(\[[^\[\]]*+\])')
+_RE_EQ_ARRAY = re.compile(r'=\s*(\[(?=[^\[\]]*https?://)[^\[\]]*+\])')
+# ثلاث تمريرات منفصلة عمداً لا تعبير واحد بالتناوب: تطابق خارجي لا يُحلل (مثل = [{"images": [...]}])
+# كان سيبتلع المصفوفة الداخلية فلا يجدها الفرع الآخر
+_IMAGE_ARRAY_PATTERNS = (_RE_URL_ARRAY, _RE_IMAGES_ARRAY, _RE_EQ_ARRAY)
+_RE_READER_PATH = re.compile(r"/reader/([^/]+)/(\d+)")
 
 # ---------- helpers ----------
-def try_soup(html: str):
+# شجرة أصغر: لا نحتاج التعليقات ولا تعليمات المعالجة ولا عقد المسافات الفارغة بين الوسوم
+_PARSER_OPTIONS = dict(remove_comments=True, remove_pis=True, remove_blank_text=True)
+_parser_local = threading.local()
+
+def parse_cached(html: str):
+    digest = hashlib.blake2b(html.encode("utf-8"), digest_size=16).digest()
+    with _trees_lock:
+        tree = _trees.get(digest)
+    if tree is None:
+        tree = parse_html(html)
+        with _trees_lock:
+            _trees[digest] = tree
+    return tree
+
+def _html_parser() -> lxml_html.HTMLParser:
+    # محلل واحد لكل خيط: محللات lxml لا تُشارك بين الخيوط
+    parser = getattr(_parser_local, "parser", None)
+    if parser is None:
+        parser = _parser_local.parser = lxml_html.HTMLParser(**_PARSER_OPTIONS)
+    return parser
+
+def parse_html(html: str):
     try:
-        return BeautifulSoup(html, "lxml")
-    except Exception:
-        return BeautifulSoup(html, "html.parser")
+        return lxml_html.fromstring(html, parser=_html_parser())
+    except ValueError:
+        # نص Unicode يحمل تصريح ترميز <?xml ...?>: نمرره كـ bytes بترميز صريح
+        return lxml_html.fromstring(html.encode("utf-8"), parser=lxml_html.HTMLParser(encoding="utf-8", **_PARSER_OPTIONS))
+    except etree.ParserError:
+        # مستند فارغ (lxml يتعافى من كل ما عداه): شجرة فارغة تعطي نتائج فارغة بدلاً من خطأ
+        return lxml_html.Element("html")
+
+_BASE_NOSLASH = BASE.rstrip("/")
+
+def _join(href: str) -> str:
+    # مسار سريع للحالات الشائعة بدلاً من urljoin (التي تحلل الرابطين في كل استدعاء)
+    if href.startswith("http://") or href.startswith("https://"): return href
+    if href.startswith("//"): return "https:" + href
+    if href.startswith("/"): return _BASE_NOSLASH + href
+    return urljoin(BASE, href)
+
+def select_one(node, *selectors: etree.XPath):
+    for sel in selectors:
+        found = sel(node)
+        if found: return found[0]
+    return None
+
+def text_of(el) -> str:
+    return "".join(t.strip() for t in el.itertext())
+
+_proxy_health: Dict[str, deque] = {}
+_proxy_rr = itertools.count()  # مؤشر التدوير الدائري بين البروكسيات
+_proxy_latency: Dict[str, tuple] = {}  # (EWMA لزمن وصول الترويسات, وقت آخر قياس) لكل بروكسي
+
+def proxy_success_rate(proxy: str) -> float:
+    history = _proxy_health.get(proxy)
+    return sum(history) / len(history) if history else 1.0
+
+def record_proxy_result(proxy: Optional[str], ok: bool, latency: Optional[float] = None):
+    if proxy is None: return
+    _proxy_health.setdefault(proxy, deque(maxlen=PROXY_HEALTH_WINDOW)).append(ok)
+    if latency is not None:
+        now = time.monotonic()
+        prev = _proxy_latency.get(proxy)
+        # تاريخ قديم لا يُمزج: البروكسي الذي تعافى يُقاس من جديد بدلاً من أن يجرّه بطؤه السابق
+        ewma = latency if prev is None or now - prev[1] > PROXY_LATENCY_MAX_AGE else prev[0] + PROXY_LATENCY_ALPHA * (latency - prev[0])
+        _proxy_latency[proxy] = (ewma, now)
+
+def _fresh_latency(proxy: str, now: float) -> Optional[float]:
+    sample = _proxy_latency.get(proxy)
+    return sample[0] if sample and now - sample[1] <= PROXY_LATENCY_MAX_AGE else None
+
+def pick_proxy() -> Optional[str]:
+    if not PROXIES_LIST: return None
+    healthy = [p for p in PROXIES_LIST if proxy_success_rate(p) >= PROXY_MIN_SUCCESS_RATE]
+    # إذا تعثرت كل البروكسيات نعود إلى القائمة كاملة بدلاً من التوقف
+    candidates = healthy or PROXIES_LIST
+    # تدوير دائري بدلاً من العشوائي: كل عميل يبقى دافئاً ويُعاد استخدام اتصالاته بالتساوي
+    i = next(_proxy_rr) % len(candidates)
+    current, neighbour = candidates[i], candidates[(i + 1) % len(candidates)]
+    # ونفضّل الأسرع من الدور الحالي وجاره فقط حين يملك كلاهما قياساً حديثاً؛ صاحب الدور
+    # بلا قياس حديث يأخذ دوره دائماً فيُعاد قياسه ولا يُقصى بسبب بطء قديم
+    now = time.monotonic()
+    mine, theirs = _fresh_latency(current, now), _fresh_latency(neighbour, now)
+    return neighbour if mine is not None and theirs is not None and theirs * PROXY_LATENCY_SLACK < mine else current
+
+_circuits: Dict[str, dict] = {}
+
+class CircuitOpenError(HTTPException):
+    """رفض من قاطع الدائرة نفسه، لا عطل فعلي من الموقع: لا يُخزن في الذاكرة السلبية."""
+
+def circuit_check(host: str):
+    state = _circuits.get(host)
+    if state and time.monotonic() - state["opened_at"] < state["open_for"]:
+        raise CircuitOpenError(status_code=503, detail="Upstream is failing, try again shortly")
+
+def circuit_record(host: str, ok: bool):
+    # نجاح واحد (بما فيه محاولة الاختبار بعد انتهاء مدة الفتح) يغلق الدائرة
+    if ok:
+        _circuits.pop(host, None)
+        return
+    state = _circuits.setdefault(host, {"failures": 0, "opened_at": 0.0, "open_for": 0.0})
+    state["failures"] += 1
+    now = time.monotonic()
+    # فشل طلبات أُرسلت قبل الفتح ووصل أثناءه لا يمدد مدة الفتح: المضاعفة لفشل محاولة الاختبار فقط
+    if now - state["opened_at"] < state["open_for"]: return
+    if state["failures"] >= CIRCUIT_FAILURE_THRESHOLD:
+        state["open_for"] = min(CIRCUIT_MAX_OPEN, state["open_for"] * 2 or CIRCUIT_MIN_OPEN)
+        state["opened_at"] = now
+
+async def prewarm_clients(clients):
+    async def warm(client: httpx.AsyncClient):
+        try:
+            await client.head(BASE + "/", headers=random.choice(ROTATING_HEADERS), timeout=10)
+        except httpx.HTTPError as e:
+            logger.warning(f"Connection prewarm failed: {e!r}")
+    await asyncio.gather(*(warm(c) for c in clients))
+
+def build_client(proxy: Optional[str]) -> httpx.AsyncClient:
+    options = dict(headers=DEFAULT_HEADERS, timeout=20, follow_redirects=True)
+    if proxy is None and not _ENV_PROXIED:
+        # retries على مستوى النقل تعيد فشل الاتصال فقط (ConnectError/ConnectTimeout) فوراً وبلا تكلفة،
+        # أما backoff حول fetch_html فيبقى لأخطاء القراءة والحالات العابرة (429/5xx)
+        options["transport"] = httpx.AsyncHTTPTransport(http2=HTTP2_ENABLED, limits=HTTP_LIMITS, retries=CONNECT_RETRIES)
+    else:
+        # نقل صريح يجعل httpx يتجاهل HTTP(S)_PROXY/NO_PROXY، و retries لا تعمل عبر البروكسي أصلاً
+        options.update(http2=HTTP2_ENABLED, limits=HTTP_LIMITS, proxy=proxy)
+    return httpx.AsyncClient(**options)
+
+def _is_permanent(e: Exception) -> bool:
+    return isinstance(e, httpx.HTTPStatusError) and e.response.status_code not in RETRY_STATUSES
+
+@backoff.on_exception(backoff.expo, (httpx.TransportError, httpx.HTTPStatusError), max_tries=4,
+                      max_time=RETRY_MAX_TIME, max_value=RETRY_MAX_WAIT, giveup=_is_permanent)
+def _sniff_html_head(buf: bytearray, proxy: Optional[str]):
+    # فحص رخيص على مستوى البايتات لأول SNIFF_BYTES قبل إكمال التنزيل
+    head = bytes(buf[:SNIFF_BYTES]).lower()
+    if b"just a moment" in head and b"challenge" in head:
+        record_proxy_result(proxy, False)
+        raise HTTPException(status_code=503, detail="Upstream is serving a Cloudflare challenge")
+    if b"<html" not in head and b"<!doctype" not in head and b"<body" not in head:
+        raise HTTPException(status_code=502, detail="Upstream returned a non-HTML body")
 
-@backoff.on_exception(backoff.expo, (httpx.RequestError, httpx.HTTPStatusError), max_tries=5, max_time=60)
 async def fetch_html(url: str, timeout: int = 20) -> str:
     """
     جلب HTML مع تدوير البروكسي والهوية، نظام محاولات متكررة مع backoff exponential، وتأخير عشوائي.
     """
-    # تأخير عشوائي لتجنب الكشف عن نمط
-    time.sleep(random.uniform(MIN_DELAY, MAX_DELAY))
+    host = urlparse(url).netloc
+    circuit_check(host)
+    # تأخير عشوائي لتجنب الكشف عن نمط - كل طلب يحجز خانته الزمنية قبل النوم، فالطلبات
+    # المتزامنة تصطف بفواصل عشوائية بدلاً من أن تنطلق معاً؛ والخادم الخامل يُرسل فوراً
+    global _next_fetch_at, _encoding_logged
+    now = time.monotonic()
+    slot = max(now, _next_fetch_at)
+    _next_fetch_at = slot + random.uniform(MIN_DELAY, MAX_DELAY)
+    if slot > now: await asyncio.sleep(slot - now)
     
-    # اختيار هوية عشوائية مع headers أكثر شمولاً لتبدو كمتصفح حقيقي
-    current_headers = {
-        "User-Agent": random.choice(USER_AGENTS),
-        "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7",
-        "Accept-Language": "ar,en-US;q=0.9,en;q=0.8",
-        "Accept-Encoding": "gzip, deflate, br",
-        "Referer": random.choice(["https://www.google.com/", "https://www.bing.com/", BASE]),
-        "Connection": "keep-alive",
-        "Upgrade-Insecure-Requests": "1",
-        "Sec-Fetch-Dest": "document",
-        "Sec-Fetch-Mode": "navigate",
-        "Sec-Fetch-Site": "none",
-        "Sec-Fetch-User": "?1"
-    }
+    # الهوية والمُحيل بالتدوير (باقي الـ headers مضبوطة على العميل)
+    current_headers = ROTATING_HEADERS[next(_headers_rr) % len(ROTATING_HEADERS)]
     
-    # اختيار بروكسي عشوائي (إذا كانت القائمة غير فارغة)
-    current_proxy = random.choice(PROXIES_LIST) if PROXIES_LIST else None
+    # اختيار البروكسي التالي من السليمة (إذا كانت القائمة غير فارغة)
+    current_proxy = pick_proxy()
+    
+    # طلب مشروط بآخر ETag/Last-Modified معروف لهذا الرابط
+    known = _validators.get(url)
+    if known:
+        etag, last_modified = known[:2]
+        current_headers = dict(current_headers)  # لا نعدّل التركيبة المشتركة
+        if etag: current_headers["If-None-Match"] = etag
+        if last_modified: current_headers["If-Modified-Since"] = last_modified
     
     logger.info(f"Fetching: {url} | Proxy: {current_proxy} | UA: {current_headers['User-Agent']}")
     
-    async with httpx.AsyncClient(
-        timeout=timeout,
-        headers=current_headers,
-        proxy=current_proxy,
-        follow_redirects=True
-    ) as client:
-        r = await client.get(url)
-        r.raise_for_status()
-        return r.text
+    client = app.state.clients[current_proxy]
+    # فحص ثانٍ بعد انتظار الخانة: ربما فُتحت الدائرة أثناء نومنا فلا نضرب موقعاً معطلاً
+    circuit_check(host)
+    try:
+        async with UPSTREAM_SEM:
+            started = time.monotonic()
+            async with client.stream("GET", url, headers=current_headers, timeout=timeout) as r:
+                latency = time.monotonic() - started  # زمن وصول الترويسات، مستقل عن حجم الصفحة
+                if r.status_code == 304 and known:
+                    html = known[2].decode(known[3], errors="replace")
+                else:
+                    r.raise_for_status()
+                    # فحص نوع المحتوى قبل تنزيل الجسم: لا نقرأ ميغابايتات من JSON/صور/ملفات بلا فائدة
+                    content_type = r.headers.get("content-type", "").lower()  # أنواع الوسائط لا تميّز حالة الأحرف
+                    if content_type and "html" not in content_type and not content_type.startswith("text/"):
+                        raise HTTPException(status_code=502, detail=f"Upstream returned non-HTML content ({content_type})")
+                    # نسجل مرة واحدة هل يضغط الموقع الردود فعلاً (gzip/br) أم يرسلها خاماً
+                    if not _encoding_logged:
+                        logger.info(f"Upstream content-encoding: {r.headers.get('content-encoding', 'identity')}")
+                        _encoding_logged = True
+                    buf = bytearray()
+                    sniffed = False
+                    async for chunk in r.aiter_bytes():
+                        buf.extend(chunk)
+                        # نفحص البداية فور وصولها فنقطع الاتصال مبكراً بدل تنزيل صفحة تحدٍّ أو ملف كامل
+                        if not sniffed and len(buf) >= SNIFF_BYTES:
+                            _sniff_html_head(buf, current_proxy); sniffed = True
+                        if len(buf) > MAX_HTML_BYTES:
+                            logger.warning(f"Truncating oversized response from {url} at {len(buf)} bytes")
+                            break
+                    if not sniffed: _sniff_html_head(buf, current_proxy)  # جسم أقصر من SNIFF_BYTES
+                    encoding = r.encoding or "utf-8"
+                    html = buf.decode(encoding, errors="replace")
+                    etag, last_modified = r.headers.get("etag"), r.headers.get("last-modified")
+                    if (etag or last_modified) and len(buf) <= VALIDATOR_MAX_BYTES:
+                        _validators[url] = (etag, last_modified, bytes(buf), encoding)
+    except httpx.HTTPStatusError as e:
+        # 403/429 تعني غالباً أن البروكسي محظور، أما 404 وأمثالها فليست ذنبه
+        record_proxy_result(current_proxy, e.response.status_code not in (403, 429))
+        circuit_record(host, e.response.status_code not in RETRY_STATUSES)
+        raise
+    except httpx.RequestError:
+        record_proxy_result(current_proxy, False)
+        circuit_record(host, False)
+        raise
+    record_proxy_result(current_proxy, True, latency)
+    circuit_record(host, True)
+    return html
 
+_SLUG_MARKERS = ("manga", "reader")
+
+@lru_cache(maxsize=4096)  # نفس الروابط تتكرر عبر صفحات القائمة
 def extract_slug_from_href(href: str) -> str:
     if not href: return ""
-    href = href.strip("/")
-    parts = href.split("/")
-    if "manga" in parts:
-        try: return parts[parts.index("manga") + 1]
-        except: pass
-    if "reader" in parts:
-        try: return parts[parts.index("reader") + 1]
-        except: pass
+    parts = href.strip("/").split("/")
+    for marker in _SLUG_MARKERS:
+        if marker not in parts: continue  # فحص مباشر بدلاً من ValueError كتحكم في التدفق
+        i = parts.index(marker)
+        if i + 1 < len(parts): return parts[i + 1]
     return parts[-1]
 
+def unique_by_slug(anchors) -> Dict[str, tuple]:
+    # أول رابط لكل slug بترتيب الصفحة (الـ dict يحفظ ترتيب الإدراج)
+    cards = {}
+    for a in anchors:
+        href = a.get("href") or ""
+        cards.setdefault(extract_slug_from_href(href), (href, a))
+    cards.pop("", None)
+    return cards
+
+# أنواع MIME الخاصة بـ JavaScript كما يعدّها معيار HTML (JavaScript MIME type essence match)
+_JS_MIME_TYPES = frozenset((
+    "application/ecmascript", "application/javascript", "application/x-ecmascript", "application/x-javascript",
+    "text/ecmascript", "text/javascript", "text/javascript1.0", "text/javascript1.1", "text/javascript1.2",
+    "text/javascript1.3", "text/javascript1.4", "text/javascript1.5", "text/jscript", "text/livescript",
+    "text/x-ecmascript", "text/x-javascript",
+))
+
+def _is_data_script(script_type: Optional[str]) -> bool:
+    # JS أو JSON فقط؛ القوالب (text/template, text/x-handlebars...) لا تحمل مصفوفة الصور
+    t = (script_type or "").split(";", 1)[0].strip().lower()  # الجوهر فقط: بلا معاملات ولا مسافات
+    return not t or t == "module" or t in _JS_MIME_TYPES or t.endswith("json")
+
 def find_json_arrays_in_text(text: str) -> List:
+    """
+    يستخرج روابط الصور من مصفوفات JSON داخل نص سكربت.
+
+    >>> find_json_arrays_in_text('var data = [{"images": ["https://a/1.jpg","https://a/2.jpg"]}];')
+    ['https://a/1.jpg', 'https://a/2.jpg']
+    """
+    # كل فروع التعبير تحتاج "[" ومعها http أو images: فحص substring رخيص قبل محرك التعابير
+    # ("images" يغطي مصفوفات الروابط النسبية مثل images: ["/uploads/..."] التي لا تحتوي http)
+    if "[" not in text or ("http" not in text and "images" not in text): return []
     found = []
-    arrays = re.findall(r'\[\s*(?:"https?://[^"]+"(?:\s*,\s*"https?://[^"]+")*)\s*\]', text)
-    for a in arrays:
-        try:
-            parsed = json.loads(a)
-            if isinstance(parsed, list): found.extend(parsed)
-        except: continue
-    m = re.findall(r'(["\']?images["\']?\s*:\s*\[.*?\])', text, flags=re.DOTALL)
-    for group in m:
-        try:
-            obj = "{" + group + "}"
-            parsed = json.loads(obj)
-            imgs = parsed.get("images") or []
-            found.extend(imgs)
-        except: continue
-    m2 = re.findall(r'=\s*\[.*?https?://.*?\]', text, flags=re.DOTALL)
-    for g in m2:
-        try:
-            parsed = json.loads(g.strip().lstrip("=").strip())
-            if isinstance(parsed, list): found.extend(parsed)
-        except: continue
-    seen = set(); uniq = []
-    for u in found:
-        if isinstance(u, str) and u not in seen:
-            uniq.append(u); seen.add(u)
-    return uniq
+    for pattern in _IMAGE_ARRAY_PATTERNS:
+        for a in pattern.findall(text):
+            try:
+                parsed = json_loads(a)
+                if isinstance(parsed, list): found.extend(parsed)
+            except: continue
+    return list(dict.fromkeys(u for u in found if isinstance(u, str)))
 
 # ---------- endpoints ----------
 @app.get("/manga-list")
-async def manga_list(sort: str = Query("views"), page: int = Query(1, ge=1)):
-    url = f"{BASE}/manga-list?sort={sort}"
+async def manga_list(request: Request, sort: str = Query("views"), page: int = Query(1, ge=1)):
+    sort = sort.strip() or "views"  # " views" و "views" نفس الصفحة؛ حالة الأحرف تُمرر كما هي للموقع
+    return json_bytes_response(await cached(_cache_key("list", sort, page), lambda: _manga_list(sort, page)), request)
+
+async def _manga_list(sort: str, page: int) -> Dict[str, Any]:
+    url = f"{BASE}/manga-list?sort={quote(sort, safe='')}"  # لا يحقن & أو = معاملات إضافية
     if page > 1: url += f"&page={page}"
     html = await fetch_html(url)
-    soup = try_soup(html)
+    # التحليل والاستخراج في خيط منفصل (lxml يحرر الـ GIL) حتى لا تتجمد حلقة الأحداث على الصفحات الكبيرة
+    return await asyncio.to_thread(_parse_manga_list, html, page)
+
+def _parse_manga_list(html: str, page: int) -> Dict[str, Any]:
+    tree = parse_cached(html)
     items = []
-    seen_slugs = set()
-    for a in soup.select("a.manga-card"):
-        href = a.get("href") or ""
-        slug = extract_slug_from_href(href)
-        if not slug or slug in seen_slugs: continue
-        seen_slugs.add(slug)
-        title = (a.select_one("img").get("alt") if a.select_one("img") else a.get_text(strip=True)) or slug
-        cover = a.select_one("img").get("src") if a.select_one("img") else None
-        items.append({"title": title.strip(), "slug": slug, "url": urljoin(BASE, href), "cover": cover})
+    for slug, (href, a) in unique_by_slug(SEL_MANGA_CARD(tree)).items():
+        img = a.find(".//img")
+        title = (img.get("alt") if img is not None else text_of(a)) or slug
+        cover = img.get("src") if img is not None else None
+        items.append({"title": title.strip(), "slug": slug, "url": _join(href), "cover": cover})
     if not items:
-        for a in soup.select("a[href*='/manga/']"):
-            href = a.get("href") or ""
-            slug = extract_slug_from_href(href)
-            if not slug or slug in seen_slugs: continue
-            seen_slugs.add(slug)
-            title_el = a.select_one("h3") or a.select_one(".title") or a.select_one("h2")
-            title = title_el.get_text(strip=True) if title_el else a.get_text(strip=True)
-            img = a.select_one("img")
-            cover = img.get("data-src") or img.get("src") if img else None
-            items.append({"title": title.strip(), "slug": slug, "url": urljoin(BASE, href), "cover": cover})
+        for slug, (href, a) in unique_by_slug(SEL_MANGA_LINK(tree)).items():
+            title_el = select_one(a, *SEL_CARD_TITLE)
+            title = text_of(title_el) if title_el is not None else text_of(a)
+            img = a.find(".//img")
+            cover = img.get("data-src") or img.get("src") if img is not None else None
+            items.append({"title": title.strip(), "slug": slug, "url": _join(href), "cover": cover})
     pagination = {"current": page, "pages": []}
-    pager = soup.select_one("nav[aria-label='الصفحات']") or soup.select_one(".pagination") or soup.select_one(".pagenavi")
-    if pager:
-        for a in pager.select("a[href]"):
-            pagination["pages"].append({"page": a.get_text(strip=True), "url": urljoin(BASE, a.get("href"))})
+    pager = select_one(tree, SEL_PAGER)
+    if pager is not None:
+        for a in SEL_LINK(pager):
+            pagination["pages"].append({"page": text_of(a), "url": _join(a.get("href"))})
     return {"items": items, "pagination": pagination}
 
 @app.get("/manga/{slug}")
-async def manga_detail(slug: str):
+async def manga_detail(request: Request, slug: str):
+    return json_bytes_response(await cached(_cache_key("detail", slug), lambda: _manga_detail(slug)), request)
+
+async def _manga_detail(slug: str) -> Dict[str, Any]:
     url = f"{BASE}/manga/{slug}"
     html = await fetch_html(url)
-    soup = try_soup(html)
-    title_el = soup.select_one("h1") or soup.select_one(".title") or soup.select_one(".entry-title")
-    title = title_el.get_text(strip=True) if title_el else slug
+    return await asyncio.to_thread(_parse_manga_detail, html, slug)
+
+def _parse_manga_detail(html: str, slug: str) -> Dict[str, Any]:
+    tree = parse_cached(html)
+    title_el = select_one(tree, *SEL_TITLE)
+    title = text_of(title_el) if title_el is not None else slug
     desc = None
-    desc_el = soup.select_one("p.text-gray-300") or soup.select_one(".description") or soup.select_one(".entry-content p") or soup.select_one("meta[name='description']")
-    if desc_el:
-        desc = desc_el.get("content") if desc_el.name == "meta" else desc_el.get_text(strip=True)
+    desc_el = select_one(tree, *SEL_DESC)
+    if desc_el is not None:
+        desc = desc_el.get("content") if desc_el.tag == "meta" else text_of(desc_el)
     cover = None
-    cov = soup.select_one("img.cover") or soup.select_one(".cover img") or soup.select_one(".thumb img")
-    if cov: cover = cov.get("data-src") or cov.get("src")
+    cov = select_one(tree, *SEL_COVER)
+    if cov is not None: cover = cov.get("data-src") or cov.get("src")
     chapters = []
-    for a in soup.select("a[href*='/reader/']"):
+    for a in SEL_CHAPTER_LINK(tree):
         href = a.get("href") or ""
-        m = re.search(r"/reader/([^/]+)/(\d+)", href)
-        if m: chapters.append({"chapter_number": m.group(2), "url": urljoin(BASE, href), "title": a.get_text(strip=True)})
+        m = _RE_READER_PATH.search(href)
+        if m: chapters.append({"chapter_number": m.group(2), "url": _join(href), "title": text_of(a)})
     return {"title": title, "slug": slug, "description": desc, "cover": cover, "chapters": chapters}
 
+# يجب تسجيله قبل /reader/{slug}/{chapter} حتى لا تُطابق "batch" كرقم فصل
+@app.get("/reader/{slug}/batch")
+async def reader_batch(slug: str, chapters: str = Query(..., description="أرقام الفصول مفصولة بفواصل، مثل 1,2,3")):
+    try:
+        numbers = list(dict.fromkeys(int(c) for c in chapters.split(",") if c.strip()))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="chapters must be a comma-separated list of integers")
+    if not numbers or len(numbers) > MAX_BATCH_CHAPTERS:
+        raise HTTPException(status_code=400, detail=f"chapters must list between 1 and {MAX_BATCH_CHAPTERS} chapters")
+    # الفصول المخزنة تعود فوراً وطلبات الفصول الباردة تُطلق معاً، لكنها تُرسل للموقع متتابعة
+    # حسب خانات التأخير المهذب، فالزمن البارد ينمو خطياً مع عدد الفصول (انظر MAX_BATCH_CHAPTERS)
+    results = await asyncio.gather(*(cached_reader(slug, n) for n in numbers), return_exceptions=True)
+    return {
+        "slug": slug,
+        "chapters": {str(n): {"error": str(r)} if isinstance(r, BaseException) else r[0] for n, r in zip(numbers, results)},
+    }
+
 @app.get("/reader/{slug}/{chapter}")
-async def reader(slug: str, chapter: int):
+async def reader(request: Request, slug: str, chapter: int,
+                 verify: bool = Query(False, description="فحص كل صورة بطلب HEAD وإسقاط الروابط المعطلة")):
+    entry = await cached_reader(slug, chapter)
+    if not verify: return json_bytes_response(entry, request)
+    result = entry[0]
+    # الفحص بالتوازي على العميل المشترك وتحت نفس بوابة القبول
+    client = app.state.clients[pick_proxy()]
+    headers = IMAGE_PROBE_HEADERS[next(_headers_rr) % len(IMAGE_PROBE_HEADERS)]  # هوية واحدة لكل الفصل
+    alive = await asyncio.gather(*(_image_alive(client, u, headers) for u in result["images"]))
+    return {**result, "images": [u for u, ok in zip(result["images"], alive) if ok]}
+
+async def _image_alive(client: httpx.AsyncClient, url: str, headers: Dict[str, str]) -> bool:
+    try:
+        req = client.build_request("HEAD", url, headers=headers)
+        for name in _NAVIGATION_ONLY_HEADERS: req.headers.pop(name, None)
+        async with UPSTREAM_SEM:
+            r = await client.send(req)
+    except (httpx.HTTPError, httpx.InvalidURL):  # InvalidURL (سطر جديد/منفذ خاطئ في رابط مكشوط) ليس من HTTPError
+        return False
+    return r.status_code == 200
+
+def cached_reader(slug: str, chapter: int):
+    return cached(_cache_key("reader", slug, chapter), lambda: _reader(slug, chapter))
+
+async def _reader(slug: str, chapter: int) -> Dict[str, Any]:
     url = f"{BASE}/reader/{slug}/{chapter}"
     html = await fetch_html(url)
-    soup = try_soup(html)
+    return await asyncio.to_thread(_parse_reader, html, slug, chapter)
+
+def _parse_reader(html: str, slug: str, chapter: int) -> Dict[str, Any]:
+    tree = parse_cached(html)
     images = []
-    for sel in [".reader", ".reader-container", ".chapter-images", "#reader", ".rdminimal", ".page"]:
-        container = soup.select_one(sel)
-        if container:
-            for img in container.select("img"):
-                src = img.get("data-src") or img.get("data-lazy-src") or img.get("src")
-                if src and not src.startswith("data:"): images.append(src)
+    for sel in SEL_READER_CONTAINERS:
+        container = select_one(tree, sel)
+        if container is not None:
+            images.extend(XP_READER_IMAGE_SRCS(container))
             if images: break
     if not images:
-        scripts = soup.find_all("script")
+        scripts = SEL_SCRIPT(tree)
         for s in scripts:
-            found = find_json_arrays_in_text(s.string or s.get_text() or "")
+            # سكربتات خارجية أو قوالب أو قصيرة جداً لا تحمل مصفوفة صور (فحص المحتوى داخل الدالة)
+            if s.get("src") or not _is_data_script(s.get("type")): continue
+            text = s.text or ""
+            if len(text) < 20: continue
+            found = find_json_arrays_in_text(text)
             if found: images.extend(found); break
-    clean = []
-    seen = set()
-    for src in images:
-        src = urljoin(BASE, src.strip().replace("//", "https://") if src.startswith("//") else src.strip())
-        if src not in seen:
-            seen.add(src)
-            clean.append(src)
+    # تطبيع وإزالة تكرار في مرور واحد دون قائمة وسيطة
+    clean = list(dict.fromkeys(_join(src.strip()) for src in images))
     return {"slug": slug, "chapter": chapter, "images": clean}
 
 @app.get("/_health")